@@ -0,0 +1,49 @@
+"""
+A minimal PNG encoder for uint8 numpy arrays.
+
+Images are written as a single IDAT chunk with the fastest zlib level, where
+every scanline uses the Up filter (the difference from the previous row).
+Unlike Pillow, no filter is chosen per row, which is much cheaper for the
+images usually drawn on a terminal; smooth images still compress about as
+well as with Pillow at the same zlib level.
+"""
+
+import struct
+import zlib
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+_IHDR = struct.Struct('>LLBBBBB')
+_LENGTH = struct.Struct('>L')
+
+# number of channels -> PNG color type (grayscale, RGB, RGBA)
+_COLOR_TYPES = {1: 0, 3: 2, 4: 6}
+
+
+def _chunk(tag, data):
+    crc = zlib.crc32(data, zlib.crc32(tag))
+    return (_LENGTH.pack(len(data)), tag, data, _LENGTH.pack(crc))
+
+
+def encode_png(im, compress_level=1) -> bytes:
+    '''Encode an uint8 ndarray of shape (H, W) or (H, W, C) where C is
+    1, 3, or 4 (grayscale, RGB, RGBA) into PNG.'''
+    import numpy
+
+    height, width = im.shape[:2]
+    channels = im.shape[2] if im.ndim == 3 else 1
+    color_type = _COLOR_TYPES[channels]
+
+    # each scanline is prepended with its filter type (2: Up), followed by
+    # the difference from the previous scanline (the first one is as is)
+    rows = im.reshape(height, width * channels)
+    raw = numpy.empty((height, width * channels + 1), dtype=numpy.uint8)
+    raw[:, 0] = 2
+    raw[:1, 1:] = rows[:1]
+    numpy.subtract(rows[1:], rows[:-1], out=raw[1:, 1:])
+
+    ihdr = _IHDR.pack(width, height, 8, color_type, 0, 0, 0)
+    return b''.join((PNG_SIGNATURE,
+                     *_chunk(b'IHDR', ihdr),
+                     *_chunk(b'IDAT', zlib.compress(raw, compress_level)),
+                     *_chunk(b'IEND', b'')))
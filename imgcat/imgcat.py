@@ -2,178 +2,393 @@
 imgcat in Python.
 """
 
-from typing import Any, Optional, TYPE_CHECKING, Tuple
+from typing import Any, Optional, TYPE_CHECKING, Tuple, Union
 
+import collections
 import contextlib
 import io
+import mmap
 import os
 import struct
-import subprocess
 import sys
-from urllib.request import urlopen
+import threading
+import time
 
 
 if TYPE_CHECKING:
     import matplotlib.figure  # type: ignore
+    import numpy  # type: ignore
     import torch  # type: ignore
     from PIL import Image  # type: ignore
 
 
-def get_image_shape(buf: bytes) -> Tuple[Optional[int], Optional[int]]:
+# The content of an image, as accepted by get_image_shape and imgcat
+_Buffer = Union[bytes, bytearray, memoryview, mmap.mmap]
+
+
+# Image shapes that required PIL to determine, for the recently seen buffers.
+_SHAPE_CACHE: 'collections.OrderedDict[tuple, Tuple[int, int]]' = collections.OrderedDict()
+_SHAPE_CACHE_MAXSIZE = 64
+_SHAPE_CACHE_LOCK = threading.Lock()
+
+# The number of elements converted at a time by _float_to_uint8
+_FLOAT_BLOCK_SIZE = 1 << 16
+
+# PIL image formats that can be sent to the terminal as they are.
+_PASSTHROUGH_FORMATS = ('PNG', 'JPEG', 'GIF', 'BMP')
+
+# Image header fields, compiled once
+_GIF_SHAPE = struct.Struct("<HH")             # width, height
+_PNG_SHAPE = struct.Struct(">LL")             # width, height
+_JPEG_SEGMENT_LENGTH = struct.Struct(">H")
+_JPEG_SOF_SHAPE = struct.Struct(">HH")        # height, width
+_BMP_HEADER_SIZE = struct.Struct("<I")
+_BMP_CORE_SHAPE = struct.Struct("<HH")        # width, height
+_BMP_INFO_SHAPE = struct.Struct("<ii")        # width, height
+_WEBP_VP8_SHAPE = struct.Struct("<HH")        # width, height
+_WEBP_VP8L_SHAPE = struct.Struct("<I")        # bit-packed width, height
+
+
+def get_image_shape(buf: _Buffer) -> Tuple[Optional[int], Optional[int]]:
     '''
     Extracts image shape as 2-tuple (width, height) from the content buffer.
 
-    Supports GIF, PNG and other image types (e.g. JPEG) if PIL/Pillow is installed.
+    Supports GIF, PNG, JPEG, BMP and WEBP by parsing the image header,
+    and other image types if PIL/Pillow is installed.
     Returns (None, None) if it can't be identified.
     '''
-    def _unpack(fmt, buffer, mode='Image'):
-        try:
-            return struct.unpack(fmt, buffer)
-        except struct.error:
-            raise ValueError("Invalid {} file".format(mode))
-
     # TODO: handle 'stream-like' data efficiently, not storing all the content into memory
     L = len(buf)
 
     if L >= 10 and buf[:6] in (b'GIF87a', b'GIF89a'):
-        return _unpack("<hh", buf[6:10], mode='GIF')
-    elif L >= 24 and buf.startswith(b'\211PNG\r\n\032\n') and buf[12:16] == b'IHDR':
-        return _unpack(">LL", buf[16:24], mode='PNG')
-    elif L >= 16 and buf.startswith(b'\211PNG\r\n\032\n'):
-        return _unpack(">LL", buf[8:16], mode='PNG')
+        return _GIF_SHAPE.unpack_from(buf, 6)
+    elif L >= 16 and buf[:8] == b'\211PNG\r\n\032\n':
+        if L >= 24 and buf[12:16] == b'IHDR':
+            return _PNG_SHAPE.unpack_from(buf, 16)
+        else:
+            return _PNG_SHAPE.unpack_from(buf, 8)
+    elif L >= 4 and buf[:2] == b'\xff\xd8':
+        shape = _jpeg_shape(buf)
+    elif L >= 26 and buf[:2] == b'BM':
+        shape = _bmp_shape(buf)
+    elif L >= 30 and buf[:4] == b'RIFF' and buf[8:12] == b'WEBP':
+        shape = _webp_shape(buf)
     else:
-        # everything else: get width/height from PIL
-        # TODO: it might be inefficient to write again the memory-loaded content to buffer...
-        b = io.BytesIO()
-        b.write(buf)
+        shape = None
+
+    if shape is not None:
+        return shape
+
+    # everything else: get width/height from PIL
+    if not isinstance(buf, bytes):
+        return _pil_image_shape(buf)
+
+    # bytes are immutable, but id() can be reused once the object is freed;
+    # so part of the content is also compared to tell the buffers apart.
+    key = (id(buf), L, buf[:32], buf[-16:])
+    with _SHAPE_CACHE_LOCK:
+        if key in _SHAPE_CACHE:
+            _SHAPE_CACHE.move_to_end(key)
+            return _SHAPE_CACHE[key]
+
+    # PIL is not called with the lock held; at worst, another thread
+    # determines the same shape concurrently.
+    width, height = _pil_image_shape(buf)
+    if width is not None and height is not None:
+        with _SHAPE_CACHE_LOCK:
+            _SHAPE_CACHE[key] = (width, height)
+            if len(_SHAPE_CACHE) > _SHAPE_CACHE_MAXSIZE:
+                _SHAPE_CACHE.popitem(last=False)
+    return width, height
+
+
+def _pil_image_shape(buf: _Buffer) -> Tuple[Optional[int], Optional[int]]:
+    # an initial bytes value is shared by BytesIO (until written), not copied;
+    # other buffers (bytearray, memoryview, mmap) are copied
+    b = io.BytesIO(buf)
 
-        try:
-            import PIL   # noqa
-        except ImportError:
-            # PIL not available
-            sys.stderr.write("Warning: cannot determine the image size; please install Pillow" + "\n")
-            sys.stderr.flush()
-            return None, None
-
-        from PIL import Image, UnidentifiedImageError
-        try:
-            im = Image.open(b)
-            return im.width, im.height
-        except UnidentifiedImageError:
-            # PIL.Image.open throws an error -- probably invalid byte input are given
-            sys.stderr.write("Warning: PIL cannot identify image size; this may not be an image file" + "\n")
-            return None, None
-        finally:
-            b.close()
+    try:
+        import PIL   # noqa
+    except ImportError:
+        # PIL not available
+        sys.stderr.write("Warning: cannot determine the image size; please install Pillow" + "\n")
+        sys.stderr.flush()
+        return None, None
 
+    from PIL import Image, UnidentifiedImageError
+    try:
+        im = Image.open(b)
+        return im.width, im.height
+    except UnidentifiedImageError:
+        # PIL.Image.open throws an error -- probably invalid byte input are given
+        sys.stderr.write("Warning: PIL cannot identify image size; this may not be an image file" + "\n")
+        return None, None
+    finally:
+        b.close()
+
+
+def _jpeg_shape(buf: _Buffer) -> Optional[Tuple[int, int]]:
+    """Find (width, height) from the SOFn marker of a JPEG image, or None."""
+    L = len(buf)
+    i = 2
+    while i + 9 <= L:
+        if buf[i] != 0xFF:
+            return None   # not at a marker; the stream is probably corrupted
+        marker = buf[i + 1]
+        if marker == 0xFF:
+            i += 1        # fill byte
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            i += 2        # standalone markers, without any length field
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            # SOFn: length(2), precision(1), height(2), width(2)
+            height, width = _JPEG_SOF_SHAPE.unpack_from(buf, i + 5)
+            return width, height
+        if marker in (0xD9, 0xDA):
+            return None   # EOI or SOS, there is no SOFn marker before scans
+        seglen, = _JPEG_SEGMENT_LENGTH.unpack_from(buf, i + 2)
+        i += 2 + seglen
+    return None
+
+
+def _bmp_shape(buf: _Buffer) -> Optional[Tuple[int, int]]:
+    """Find (width, height) from the DIB header of a BMP image, or None."""
+    header_size, = _BMP_HEADER_SIZE.unpack_from(buf, 14)
+    if header_size == 12:
+        # BITMAPCOREHEADER (OS/2)
+        return _BMP_CORE_SHAPE.unpack_from(buf, 18)
+    elif header_size >= 40:
+        # BITMAPINFOHEADER and later; negative height means top-down bitmap
+        width, height = _BMP_INFO_SHAPE.unpack_from(buf, 18)
+        return abs(width), abs(height)
+    return None
+
+
+def _webp_shape(buf: _Buffer) -> Optional[Tuple[int, int]]:
+    """Find (width, height) from the first chunk of a WEBP image, or None."""
+    chunk = buf[12:16]
+    if chunk == b'VP8 ' and buf[23:26] == b'\x9d\x01\x2a':
+        # lossy: 14-bit width and height follow the frame start code
+        width, height = _WEBP_VP8_SHAPE.unpack_from(buf, 26)
+        return width & 0x3FFF, height & 0x3FFF
+    elif chunk == b'VP8L' and buf[20] == 0x2F:
+        # lossless: 14-bit (width - 1) and (height - 1), bit-packed
+        bits, = _WEBP_VP8L_SHAPE.unpack_from(buf, 21)
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    elif chunk == b'VP8X':
+        # extended: 24-bit (canvas width - 1) and (canvas height - 1)
+        width = int.from_bytes(buf[24:27], 'little') + 1
+        height = int.from_bytes(buf[27:30], 'little') + 1
+        return width, height
+    return None
+
+
+def _float_to_uint8(im: 'numpy.ndarray') -> 'numpy.ndarray':
+    '''Scales an image of floats in [0, 1] to uint8, rounding to the nearest
+    and clipping out-of-range values (rather than letting them wrap around).
+
+    The conversion is done over blocks of rows, so that the float temporaries
+    stay small no matter how large the image is.'''
+    import numpy
+    scaled = numpy.empty(im.shape, dtype=numpy.uint8)
+    dtype = numpy.promote_types(im.dtype, numpy.float32)
+    rows = max(1, _FLOAT_BLOCK_SIZE * im.shape[0] // max(1, im.size))
+    for i in range(0, im.shape[0], rows):
+        block = numpy.multiply(im[i:i + rows], 255, dtype=dtype)
+        numpy.clip(block, 0, 255, out=block)
+        numpy.rint(block, out=block)
+        scaled[i:i + rows] = block
+    return scaled
+
+
+def _ndarray_to_content_buf(im: 'numpy.ndarray') -> Union[bytes, memoryview]:
+    # numpy ndarray: convert to png
+    import numpy
+    if len(im.shape) == 2:
+        mode = 'L'     # 8-bit pixels, grayscale
+        im = im.astype(numpy.uint8, copy=False)
+    elif len(im.shape) == 3 and im.shape[2] in (1, 3, 4):
+        # (H, W, C) format
+        mode = None    # RGB/RGBA
+        if im.dtype.kind == 'f':
+            im = _float_to_uint8(im)
+        if im.shape[2] == 1:
+            mode = 'L'  # 8-bit grayscale
+            im = numpy.squeeze(im, axis=2)
+    elif len(im.shape) == 3 and im.shape[0] in (1, 3, 4):
+        # (C, H, W) format
+        mode = None    # RGB/RGBA
+        im = im.transpose(1, 2, 0)  # CHW -> HWC, a view; made contiguous later
+        if im.dtype.kind == 'f':
+            im = _float_to_uint8(im)
+        if im.shape[2] == 1:
+            mode = 'L'  # 8-bit grayscale
+            im = numpy.squeeze(im, axis=2)
+    else:
+        raise ValueError("Expected a 3D ndarray (RGB/RGBA image) or 2D (grayscale image), "
+                         "but given shape: {}".format(im.shape))
 
-def _isinstance(obj, module, clsname):
-    """A helper that works like isinstance(obj, module:clsname), but even when
-    the module hasn't been imported or the type is not importable."""
+    if im.size == 0:
+        raise ValueError("cannot write empty image, given shape: {}".format(im.shape))
 
-    if module not in sys.modules:
-        return False
+    if im.dtype == numpy.uint8:
+        # cheaper than going through PIL, and works without Pillow
+        from . import _png
+        return _png.encode_png(im, compress_level=1)
 
     try:
-        clstype = getattr(sys.modules[module], clsname)
-        return isinstance(obj, clstype)
-    except AttributeError:
-        return False
-
-
-def to_content_buf(data: Any) -> bytes:
+        from PIL import Image
+    except ImportError as e:
+        raise ImportError(e.msg +
+                          "\nTo draw numpy arrays, we require Pillow. " +
+                          "(pip install Pillow)")       # TODO; reraise
+
+    # mode: https://pillow.readthedocs.io/en/4.2.x/handbook/concepts.html#concept-modes
+    pil_img = Image.fromarray(im, mode=mode)
+
+    buf = io.BytesIO()
+    # the fastest zlib level; good enough for displaying on terminal
+    pil_img.save(buf, format='png', compress_level=1)
+    return buf.getbuffer()
+
+
+def _pil_to_content_buf(img: 'Image.Image') -> Union[bytes, memoryview]:
+    # PIL/Pillow images
+
+    # An image opened from a file but not loaded yet can be displayed as the
+    # original file, without re-encoding -- as long as the file still matches
+    # the image, e.g. Image.draft() changes the mode/size before loading.
+    if (img.format in _PASSTHROUGH_FORMATS and getattr(img, 'tile', None)
+            and getattr(img, 'fp', None) is not None
+            and not getattr(img, 'decoderconfig', ())
+            and not getattr(img, 'is_animated', False)):
+        try:
+            pos = img.fp.tell()
+            img.fp.seek(0)
+            content = img.fp.read()
+            img.fp.seek(pos)
+        except (AttributeError, OSError, ValueError):
+            content = None   # e.g. a non-seekable stream
+        if content and get_image_shape(content) == img.size:
+            return content
+
+    buf = io.BytesIO()
+    img.save(buf, format='png')
+    return buf.getbuffer()
+
+
+def _figure_to_content_buf(fig: 'matplotlib.figure.Figure') -> memoryview:
+    # matplotlib figures
+    if fig.canvas is None:
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        FigureCanvasAgg(fig)
+
+    buf = io.BytesIO()
+    # the fastest zlib level, as for ndarrays
+    fig.savefig(buf, format='png', pil_kwargs={'compress_level': 1})
+    return buf.getbuffer()
+
+
+def _torch_to_content_buf(torch_img: 'torch.Tensor') -> _Buffer:
+    return to_content_buf(torch_img.numpy())
+
+
+def _tf_to_content_buf(tf_img: Any) -> _Buffer:
+    return to_content_buf(tf_img.numpy())
+
+
+# The types that to_content_buf() can convert, as (module, class name, converter).
+# imgcat never imports these modules itself: if a module hasn't been imported,
+# the data cannot be an instance of the type either.
+_LAZY_CONVERTERS = (
+    ('numpy', 'ndarray', _ndarray_to_content_buf),
+    ('torch', 'Tensor', _torch_to_content_buf),
+    ('tensorflow.python.framework.ops', 'EagerTensor', _tf_to_content_buf),
+    ('PIL.Image', 'Image', _pil_to_content_buf),
+    ('matplotlib.figure', 'Figure', _figure_to_content_buf),
+)
+
+# (len(sys.modules), [(type, converter), ...]) for the types imported so far
+_LAZY_CONVERTERS_CACHE: Tuple[int, Tuple[Tuple[type, Any], ...]] = (-1, ())
+
+
+def _lazy_converters() -> Tuple[Tuple[type, Any], ...]:
+    """Returns (type, converter) of _LAZY_CONVERTERS whose module is imported.
+    The types are looked up again only when a new module has been imported."""
+    global _LAZY_CONVERTERS_CACHE
+    num_modules = len(sys.modules)
+    if _LAZY_CONVERTERS_CACHE[0] != num_modules:
+        resolved = []
+        for module, clsname, converter in _LAZY_CONVERTERS:
+            clstype = getattr(sys.modules.get(module), clsname, None)
+            if isinstance(clstype, type):
+                resolved.append((clstype, converter))
+        _LAZY_CONVERTERS_CACHE = (num_modules, tuple(resolved))
+    return _LAZY_CONVERTERS_CACHE[1]
+
+
+def to_content_buf(data: Any) -> _Buffer:
     # TODO: handle 'stream-like' data efficiently, rather than storing into RAM
+    # NOTE: encoded images are returned as a memoryview on the BytesIO buffer,
+    # rather than as a copy of its contents (BytesIO.getvalue()).
 
-    if isinstance(data, bytes):
+    if isinstance(data, (bytes, bytearray, mmap.mmap)):
+        # the content of an image (most common), no need to convert
         return data
 
-    elif isinstance(data, io.BufferedReader):
+    elif isinstance(data, memoryview):
+        # as a flat view of bytes, so that len() is the number of bytes;
+        # non-contiguous views are rejected (TypeError)
+        return data.cast('B')
+
+    elif isinstance(data, (io.BufferedIOBase, io.RawIOBase)):
+        # binary streams, e.g. open(..., 'rb'), sys.stdin.buffer or BytesIO
         buf = data
         return buf.read()
 
     elif isinstance(data, io.TextIOWrapper):
         return data.buffer.read()
 
-    elif _isinstance(data, 'numpy', 'ndarray'):
-        # numpy ndarray: convert to png
-        import numpy
-        im: 'numpy.ndarray' = data
-        if len(im.shape) == 2:
-            mode = 'L'     # 8-bit pixels, grayscale
-            im = im.astype(sys.modules['numpy'].uint8)
-        elif len(im.shape) == 3 and im.shape[2] in (1, 3, 4):
-            # (H, W, C) format
-            mode = None    # RGB/RGBA
-            if im.dtype.kind == 'f':
-                im = (im * 255).astype('uint8')
-            if im.shape[2] == 1:
-                mode = 'L'  # 8-bit grayscale
-                im = numpy.squeeze(im, axis=2)
-        elif len(im.shape) == 3 and im.shape[0] in (1, 3, 4):
-            # (C, H, W) format
-            mode = None    # RGB/RGBA
-            im = numpy.rollaxis(im, 0, 3)  # CHW -> HWC
-            if im.dtype.kind == 'f':
-                im = (im * 255).astype('uint8')
-            if im.shape[2] == 1:
-                mode = 'L'  # 8-bit grayscale
-                im = numpy.squeeze(im, axis=2)
-        else:
-            raise ValueError("Expected a 3D ndarray (RGB/RGBA image) or 2D (grayscale image), "
-                             "but given shape: {}".format(im.shape))
+    for clstype, converter in _lazy_converters():
+        if isinstance(data, clstype):
+            return converter(data)
 
-        try:
-            from PIL import Image
-        except ImportError as e:
-            raise ImportError(e.msg +
-                              "\nTo draw numpy arrays, we require Pillow. " +
-                              "(pip install Pillow)")       # TODO; reraise
-
-        with io.BytesIO() as buf:
-            # mode: https://pillow.readthedocs.io/en/4.2.x/handbook/concepts.html#concept-modes
-            Image.fromarray(im, mode=mode).save(buf, format='png')
-            return buf.getvalue()
-
-    elif hasattr(data, '__array__'):
+    if hasattr(data, '__array__'):
         # e.g., JAX tensors
         arr_img = data.__array__()
         return to_content_buf(arr_img)
 
-    elif _isinstance(data, 'torch', 'Tensor'):
-        torch_img: 'torch.Tensor' = data
-        return to_content_buf(torch_img.numpy())
+    raise TypeError("Unsupported type : {}".format(type(data)))
 
-    elif _isinstance(data, 'tensorflow.python.framework.ops', 'EagerTensor'):
-        tf_img: Any = data
-        return to_content_buf(tf_img.numpy())
 
-    elif _isinstance(data, 'PIL.Image', 'Image'):
-        # PIL/Pillow images
-        img: 'Image.Image' = data
+# (timestamp, (rows, columns)) of the last successful get_tty_size() call
+_TTY_SIZE_CACHE: Optional[Tuple[float, Tuple[int, int]]] = None
+_TTY_SIZE_TTL = 1.0   # in seconds
 
-        with io.BytesIO() as buf:
-            img.save(buf, format='png')
-            return buf.getvalue()
 
-    elif _isinstance(data, 'matplotlib.figure', 'Figure'):
-        # matplotlib figures
-        fig: 'matplotlib.figure.Figure' = data
-        if fig.canvas is None:
-            from matplotlib.backends.backend_agg import FigureCanvasAgg
-            FigureCanvasAgg(fig)
-
-        with io.BytesIO() as buf:
-            fig.savefig(buf)
-            return buf.getvalue()
-
-    else:
-        raise TypeError("Unsupported type : {}".format(type(data)))
+def get_tty_size():
+    '''Returns the size of the current tty as (rows, columns).
 
+    The result is reused for a short while, so that displaying many images
+    in a row doesn't query the terminal for every single image.'''
+    global _TTY_SIZE_CACHE
+    now = time.monotonic()
+    if _TTY_SIZE_CACHE is not None and now - _TTY_SIZE_CACHE[0] < _TTY_SIZE_TTL:
+        return _TTY_SIZE_CACHE[1]
 
-def get_tty_size():
-    with open('/dev/tty') as tty:
-        rows, columns = subprocess.check_output(['stty', 'size'], stdin=tty).split()
-    return int(rows), int(columns)
+    try:
+        terminal_size = os.get_terminal_size(sys.stdout.fileno())
+    except (AttributeError, ValueError, OSError):
+        # stdout is not a terminal (e.g. redirected); ask the controlling tty
+        fd = os.open('/dev/tty', os.O_RDONLY)
+        try:
+            terminal_size = os.get_terminal_size(fd)
+        finally:
+            os.close(fd)
+    size = terminal_size.lines, terminal_size.columns
+    _TTY_SIZE_CACHE = (now, size)
+    return size
 
 
 def imgcat(data: Any, filename=None,
@@ -251,7 +466,7 @@ def main():
     if not sys.stdin.isatty():
         if not args.input or list(args.input) == ['-']:
             stdin = sys.stdin.buffer
-            imgcat(to_content_buf(stdin), **kwargs)
+            imgcat(stdin, **kwargs)
             return 0
 
     # imgcat from arguments
@@ -259,10 +474,13 @@ def main():
         # filename: open local file or download from web
         try:
             if fname.startswith('http://') or fname.startswith('https://'):
+                from urllib.request import urlopen
                 with contextlib.closing(urlopen(fname)) as fp:
                     buf = fp.read()  # pylint: disable=no-member
             else:
                 with io.open(fname, 'rb') as fp:
+                    # not mmap'ed: a file truncated while mapped (e.g. a plot
+                    # being rewritten) would crash the process with SIGBUS
                     buf = fp.read()
         except IOError as e:
             sys.stderr.write(str(e))
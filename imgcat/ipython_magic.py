@@ -4,7 +4,6 @@ from IPython.display import Markdown
 
 import io
 import os
-import PIL.Image
 
 
 def _is_ipython_notebook():
@@ -42,6 +41,7 @@ class ImgcatMagics(Magics):
             ret = eval(line, global_ns, local_ns)  # pylint: disable=eval-used
 
         if IS_NOTEBOOK:
+            import PIL.Image
             from .imgcat import to_content_buf
             buf = io.BytesIO(to_content_buf(ret))
             im = PIL.Image.open(buf)
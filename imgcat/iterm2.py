@@ -2,8 +2,18 @@
 iTerm2 backend for imgcat.
 """
 
+import functools
 import os
-import base64
+
+try:
+    # SIMD-accelerated base64 encoding, if available
+    from pybase64 import b64encode  # type: ignore
+except ImportError:
+    from binascii import b2a_base64
+
+    def b64encode(s):
+        return b2a_base64(s, newline=False)
+
 
 TMUX_WRAP_ST = b'\033Ptmux;'
 TMUX_WRAP_ED = b'\033\\'
@@ -12,52 +22,81 @@ OSC = b'\033]'
 CSI = b'\033['
 ST  = b'\a'      # \a = ^G (bell)
 
+# The payload is base64-encoded chunk by chunk, rather than materializing
+# the whole encoded content at once. The chunk size needs to be a multiple
+# of 3 so that no padding is inserted in the middle of the payload.
+BASE64_CHUNK_SIZE = 57 * 1024
+
+# The encoded output is written out whenever this many bytes are pending,
+# so that the whole encoded content is not held in memory at once.
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+@functools.lru_cache(maxsize=256)
+def _height_sequences(height):
+    '''Returns the ;height= field, and the CSI sequences moving the cursor up
+    and down by the given number of lines. Heights are usually small numbers
+    repeated over many images, so the formatted bytes are cached.'''
+    height_bytes = str(height).encode()
+    return (b';height=' + height_bytes,
+            CSI + height_bytes + b"F",   # PEP-461
+            CSI + height_bytes + b"E")
+
 
 def _write_image(buf, fp,
                  filename, width, height, preserve_aspect_ratio):
     # need to detect tmux
     is_tmux = 'TMUX' in os.environ and 'tmux' in os.environ['TMUX']
+    height_field, cursor_up, cursor_down = _height_sequences(height)
 
     # tmux: print some margin and the DCS escape sequence for passthrough
     # In tmux mode, we need to first determine the number of actual lines
+    # The output is assembled in a bytearray and written in large pieces,
+    # rather than issuing many small writes on a (possibly unbuffered) fp.
+    out = bytearray()
     if is_tmux:
-        fp.write(b'\n' * height)
+        out += b'\n' * height
         # move the cursers back
-        fp.write(CSI + b'?25l')
-        fp.write(CSI + str(height).encode() + b"F")     # PEP-461
-        fp.write(TMUX_WRAP_ST + b'\033')
+        out += CSI + b'?25l'
+        out += cursor_up
+        out += TMUX_WRAP_ST + b'\033'
 
     # now starts the iTerm2 file transfer protocol.
-    fp.write(OSC)
-    fp.write(b'1337;File=inline=1')
-    fp.write(b';size=' + str(len(buf)).encode())
+    out += OSC
+    out += b'1337;File=inline=1'
+    out += b';size=%d' % len(buf)
     if filename:
         if isinstance(filename, bytes):
             filename_bytes = filename
         else:
             filename_bytes = filename.encode()
-        fp.write(b';name=' + base64.b64encode(filename_bytes))
-    fp.write(b';height=' + str(height).encode())
+        out += b';name=' + b64encode(filename_bytes)
+    out += height_field
     if width:
-        fp.write(b';width=' + str(width).encode())
+        out += b';width=' + str(width).encode()
     if not preserve_aspect_ratio:
-        fp.write(b';preserveAspectRatio=0')
-    fp.write(b':')
-    fp.flush()
-
-    buf_base64 = base64.b64encode(buf)
-    fp.write(buf_base64)
+        out += b';preserveAspectRatio=0'
+    out += b':'
 
-    fp.write(ST)
+    # the view is released on every path, even if writing fails (e.g. EPIPE);
+    # otherwise it keeps buf (which may be a mmap) from being closed
+    with memoryview(buf) as mv:
+        for i in range(0, len(mv), BASE64_CHUNK_SIZE):
+            out += b64encode(mv[i:i + BASE64_CHUNK_SIZE])
+            if len(out) >= WRITE_BUFFER_SIZE:
+                fp.write(out)
+                out.clear()
 
+    out += ST
     if is_tmux:
         # terminate DCS passthrough mode
-        fp.write(TMUX_WRAP_ED)
+        out += TMUX_WRAP_ED
         # move back the cursor lines down
-        fp.write(CSI + str(height).encode() + b"E")
-        fp.write(CSI + b'?25h')
+        out += cursor_down
+        out += CSI + b'?25h'
     else:
-        fp.write(b'\n')
+        out += b'\n'
+    fp.write(out)
 
     # flush is needed so that the cursor control sequence can take effect
     fp.flush()
@@ -1,21 +1,41 @@
-import codecs
+import base64
+import collections
 import contextlib
 import functools
 import hashlib
 import io
 import os
 import sys
+import threading
+import time
+import types
 
 import matplotlib
 import numpy as np
 import pytest
 
-if (not os.environ.get('DISPLAY', '') or \
-    not matplotlib.rcParams.get('backend', None)
-    ):
+if not os.environ.get('DISPLAY', '') and matplotlib.get_backend().lower() != 'agg':
     matplotlib.use('Agg')
 
+import matplotlib.figure
+import matplotlib.pyplot as plt
+from PIL import Image, features
+
 from imgcat import imgcat
+from imgcat.imgcat import get_image_shape, get_tty_size, to_content_buf
+
+# the module, as the imgcat.imgcat attribute is the imgcat() function
+imgcat_module = sys.modules['imgcat.imgcat']
+
+
+# https://github.com/mathiasbynens/small/blob/master/png-transparent.png
+_PNG_BYTES = base64.b64decode(b'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAACklEQVR4nGMAAQAABQABDQottAAAAABJRU5ErkJggg==')
+
+# https://github.com/mathiasbynens/small/blob/master/jpeg.jpg
+_JPG_BYTES = base64.b64decode(b'/9j/2wBDAAMCAgICAgMCAgIDAwMDBAYEBAQEBAgGBgUGCQgKCgkICQkKDA8MCgsOCwkJDRENDg8QEBEQCgwSExIQEw8QEBD/yQALCAABAAEBAREA/8wABgAQEAX/2gAIAQEAAD8A0s8g/9k=')
+
+# http://probablyprogramming.com/2009/03/15/the-tiniest-gif-ever
+_GIF_BYTES = base64.b64decode(b'R0lGODlhAQABAIABAP///wAAACH5BAEKAAEALAAAAAABAAEAAAICTAEAOw==')
 
 
 @pytest.fixture
@@ -29,10 +49,38 @@ def mock_env(monkeypatch, env_profile):
         raise ValueError("Unknown profile: " + str(env_profile))
 
 
-def parametrize_env(callable, env_profiles=['plain', 'tmux']):
+@pytest.fixture(scope='module')
+def torch_tensors():
+    """Tensors for test_torch, shared across the env profiles."""
+    torch = pytest.importorskip('torch')
+    return {
+        'gray_uint8': torch.ones([1, 32, 32], dtype=torch.uint8),
+        'gray_float32': torch.ones([1, 32, 32], dtype=torch.float32),
+        'color_uint8': torch.zeros([3, 32, 32], dtype=torch.uint8),
+    }
+
 
-    @pytest.mark.usefixtures('mock_env')
-    @pytest.mark.parametrize('env_profile', env_profiles)
+@pytest.fixture(scope='module')
+def mpl_figure():
+    """A pyplot figure for test_matplotlib, shared across the env profiles."""
+    fig, ax = plt.subplots(figsize=(2, 2))
+    ax.plot([0, 1])
+    fig.tight_layout()
+    yield fig
+    plt.close(fig)
+
+
+@functools.lru_cache(maxsize=None)
+def _env_marks(env_profiles):
+    return (pytest.mark.usefixtures('mock_env'),
+            pytest.mark.parametrize('env_profile', env_profiles, ids=env_profiles))
+
+
+def parametrize_env(callable, env_profiles=('plain', 'tmux')):
+    usefixtures, parametrize = _env_marks(tuple(env_profiles))
+
+    @usefixtures
+    @parametrize
     @functools.wraps(callable)
     def _wrapped(*args, **kwargs):
         return callable(*args, **kwargs)
@@ -40,221 +88,523 @@ def parametrize_env(callable, env_profiles=['plain', 'tmux']):
     return _wrapped
 
 
-class TestImgcat:
-    '''Basic unit test. Supports TMUX and non-TMUX environment mocking.'''
+class _StdoutShim:
+    '''A minimal replacement of sys.stdout, writing to a BytesIO (.buffer).'''
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
 
-    def setUp(self):
-        sys.stdout.write('\n')
+    def write(self, s):
+        return self.buffer.write(s.encode('utf-8') if isinstance(s, str) else s)
 
-    def tearDown(self):
-        # Under verbose mode in unit test, make sure that flush stdout
-        # so that the image can be displayed immediately at proper positions
+    def flush(self):
+        self.buffer.flush()
+
+    def getvalue(self):
+        return self.buffer.getvalue()
+
+
+@contextlib.contextmanager
+def _redirect_stdout(reprint=True):
+    out = _StdoutShim()
+    buf = out.buffer
+
+    # sys.stdout.buffer is read-only, so sys.stdout itself is replaced
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(sys, 'stdout', out)
+        yield out
+
+    if reprint:
         sys.stdout.flush()
+        with buf.getbuffer() as mv:   # no copy of the captured bytes
+            try:
+                fd = sys.stdout.fileno()
+            except (AttributeError, ValueError, io.UnsupportedOperation):
+                stdout_buf = sys.stdout.buffer
+                stdout_buf.write(mv)
+                stdout_buf.flush()
+            else:
+                # bypass the buffered stdout, which would copy it again
+                written = 0
+                while written < len(mv):
+                    written += os.write(fd, mv[written:])
 
-    @contextlib.contextmanager
-    def _redirect_stdout(self, reprint=True):
-        buf = io.BytesIO()
-        out = codecs.getwriter('utf-8')(buf)
-        setattr(out, 'buffer', buf)
 
-        try:
-            _original_stdout = getattr(sys, 'stdout')
-            setattr(sys, 'stdout', out)
-            yield out
-        finally:
-            setattr(sys, 'stdout', _original_stdout)
-            del _original_stdout
+def _hash(buf) -> str:
+    '''The hex digest to validate the output against (see _validate_iterm2).
+    blake2b is faster than sha1 for large payloads.'''
+    return hashlib.blake2b(buf, digest_size=20).hexdigest()
+
+
+def _validate_iterm2(buf, digest=None, sha1=None):
+    # check if graphics sequence is correct
+    assert buf.startswith(b'\x1b]1337;')
+    assert buf.endswith((b'\x07\n', b'\x07'))
+
+    if digest:
+        assert _hash(buf).startswith(digest), ("Digest mismatch")
+    if sha1:   # for the previously recorded digests
+        assert hashlib.sha1(buf).hexdigest().startswith(sha1), ("SHA1 mismatch")
+
+
+_TMUX_WRAP_ST = b'\033Ptmux;'
+_TMUX_WRAP_ED = b'\033\\'
 
-        if reprint:
-            stdout_buf = sys.stdout.buffer
-            stdout_buf.write(buf.getvalue())
-            stdout_buf.flush()
 
-    def _validate_iterm2(self, buf, sha1=None):
-        assert isinstance(buf, bytes)
+def tmux_unwrap_passthrough(b: bytes) -> bytes:
+    '''Strip out all tmux pass-through sequence and other cursor-movement
+    control sequences that come either in the beginning or in the end.'''
+    assert isinstance(b, bytes)
+    st = b.find(_TMUX_WRAP_ST)
+    ed = b.rfind(_TMUX_WRAP_ED)
+    assert st >= 0 and ed >= 0, "Does not contain \\033Ptmux; ..."
 
-        # check if graphics sequence is correct
-        assert buf.startswith(b'\x1b]1337;')
-        assert buf.endswith(b'\x07\n') or buf.endswith(b'\x07')
+    b = b[st + len(_TMUX_WRAP_ST) : ed]
+    b = b.replace(b'\033\033', b'\033')
+    return b
 
-        if sha1:
-            assert hashlib.sha1(buf).hexdigest().startswith(sha1), ("SHA1 mismatch")
+
+@pytest.fixture
+def capture_and_validate():
+    """Returns a context manager that captures stdout, and validates that
+    the graphics sequence written inside is correct."""
 
     @contextlib.contextmanager
-    def capture_and_validate(self, **kwargs):
-        with self._redirect_stdout(reprint=True) as f:
+    def _capture_and_validate(**kwargs):
+        with _redirect_stdout(reprint=True) as f:
             yield
 
         captured_bytes = f.getvalue()
 
         is_tmux = os.getenv('TMUX')
         if is_tmux:
-            captured_bytes = self.tmux_unwrap_passthrough(captured_bytes)
-        self._validate_iterm2(captured_bytes, **kwargs)
-
-    @staticmethod
-    def tmux_unwrap_passthrough(b: bytes) -> bytes:
-        '''Strip out all tmux pass-through sequence and other cursor-movement
-        control sequences that come either in the beginning or in the end.'''
-        assert isinstance(b, bytes)
-        #assert b.startswith(b'\033Ptmux;')
-        #assert b.endswith(b'\033\\')
-        try:
-            st = b.index(b'\033Ptmux;')
-            ed = b.rindex(b'\033\\')
-        except ValueError:
-            assert False, "Does not contain \\033Ptmux; ..."
-
-        b = b[st + 7 : ed]
-        b = b.replace(b'\033\033', b'\033')
-        return b
-
-    # ----------------------------------------------------------------------
-    # Basic functionality tests
-
-    @parametrize_env
-    def test_numpy(self):
-        # TODO: The test fails if tmux is enabled
-
-        # uint8, grayscale
-        a = np.ones([32, 32], dtype=np.uint8) * 128
-        with self.capture_and_validate():
-            imgcat(a)
-
-        # uint8, color image
-        with self.capture_and_validate():
-            a = np.ones([32, 32, 3], dtype=np.uint8) * 0
-            a[:, :, 0] = 255  # (255, 0, 0): red
-            imgcat(a)
-
-        # np.float32 [0..1] (#7f7f7f)
-        with self.capture_and_validate():
-            a = np.ones([32, 32, 3], dtype=np.float32) * 0.5
-            imgcat(a)
-
-        # np.float64 [0..1] (#37b24d)
-        with self.capture_and_validate():
-            a = np.ones([32, 32, 3], dtype=np.float64) * 0.5
-            a[..., 0], a[..., 1], a[..., 2] = 0x37 / 255., 0xb2 / 255., 0x4d / 255.
-            imgcat(a)
-
-    @parametrize_env
-    def test_torch(self):
-        import torch
-
-        # uint8, grayscale
-        with self.capture_and_validate():
-            a = torch.ones([1, 32, 32], dtype=torch.uint8)
-            imgcat(a)
-
-        with self.capture_and_validate():
-            a = torch.ones([1, 32, 32], dtype=torch.float32)
-            imgcat(a)
-
-        # uint8, color image
-        with self.capture_and_validate():
-            a = torch.ones([3, 32, 32], dtype=torch.uint8) * 0
-            imgcat(a)
-
-    @parametrize_env
-    def test_tensorflow(self):
+            captured_bytes = tmux_unwrap_passthrough(captured_bytes)
+        _validate_iterm2(captured_bytes, **kwargs)
+
+    return _capture_and_validate
+
+
+# ----------------------------------------------------------------------
+# Basic functionality tests
+
+@parametrize_env
+def test_numpy(capture_and_validate):
+    # TODO: The test fails if tmux is enabled
+
+    # uint8, grayscale
+    a = np.full([32, 32], 128, dtype=np.uint8)
+    with capture_and_validate():
+        imgcat(a)
+
+    # uint8, color image
+    with capture_and_validate():
+        a = np.zeros([32, 32, 3], dtype=np.uint8)
+        a[:, :, 0] = 255  # (255, 0, 0): red
+        imgcat(a)
+
+    # np.float32 [0..1] (#808080)
+    with capture_and_validate():
+        a = np.full([32, 32, 3], 0.5, dtype=np.float32)
+        imgcat(a)
+
+    # np.float64 [0..1] (#37b24d)
+    with capture_and_validate():
+        a = np.full([32, 32, 3], 0.5, dtype=np.float64)
+        a[..., 0], a[..., 1], a[..., 2] = 0x37 / 255., 0xb2 / 255., 0x4d / 255.
+        imgcat(a)
+
+    # float values are clipped to [0, 1], and rounded to the nearest integer
+    for dtype in (np.float32, np.float64):
+        for v, expected in [(1.01, 255), (-0.5, 0), (0.5, 128), (0x37 / 255., 0x37)]:
+            a = np.full([4, 4, 3], v, dtype=dtype)
+            decoded = np.asarray(Image.open(io.BytesIO(to_content_buf(a))))
+            assert (decoded == expected).all(), (dtype, v, decoded[0, 0])
+
+
+def test_numpy_large():
+    '''Large arrays are encoded as (compressed) PNG as well.'''
+
+    a = np.random.RandomState(0).randint(0, 256, [600, 800, 3], dtype=np.uint8)
+    buf = to_content_buf(a)
+    assert buf[:4] == b'\x89PNG'
+    np.testing.assert_array_equal(np.asarray(Image.open(io.BytesIO(buf))), a)
+
+    # a smooth full-HD image is well below tmux's passthrough buffer (1MiB)
+    y, x = np.mgrid[0:1080, 0:1920]
+    a = np.stack([x * 255 // 1919, y * 255 // 1079, np.full_like(x, 128)], axis=-1)
+    assert len(to_content_buf(a.astype(np.uint8))) < (1 << 20)
+
+
+@pytest.mark.parametrize('shape', [[16, 24], [16, 24, 1], [16, 24, 3], [16, 24, 4]])
+def test_numpy_png(shape):
+
+    a = np.random.RandomState(0).randint(0, 256, shape, dtype=np.uint8)
+    buf = to_content_buf(a)
+    assert buf[:4] == b'\x89PNG'
+    decoded = np.asarray(Image.open(io.BytesIO(buf)))
+    np.testing.assert_array_equal(decoded.reshape(a.shape), a)
+
+    # empty images cannot be encoded
+    for empty_shape in ([0] + shape[1:], shape[:1] + [0] + shape[2:]):
+        with pytest.raises(ValueError):
+            to_content_buf(np.zeros(empty_shape, dtype=np.uint8))
+
+
+def test_numpy_png_size():
+    '''Smooth images should compress about as well as with Pillow.'''
+
+    y, x = np.mgrid[0:512, 0:512]
+    a = np.stack([x / 2, y / 2, (x + y) / 4], axis=-1).astype(np.uint8)
+    buf = to_content_buf(a)
+    np.testing.assert_array_equal(np.asarray(Image.open(io.BytesIO(buf))), a)
+
+    b = io.BytesIO()
+    Image.fromarray(a).save(b, format='png', compress_level=1)
+    assert len(buf) < 2 * len(b.getvalue())
+
+
+@parametrize_env
+def test_torch(capture_and_validate, torch_tensors):
+    # uint8, grayscale
+    with capture_and_validate():
+        imgcat(torch_tensors['gray_uint8'])
+
+    with capture_and_validate():
+        imgcat(torch_tensors['gray_float32'])
+
+    # uint8, color image
+    with capture_and_validate():
+        imgcat(torch_tensors['color_uint8'])
+
+
+@parametrize_env
+def test_tensorflow(capture_and_validate):
+    try:
+        import tensorflow.compat.v2 as tf  # type: ignore # noqa
+    except ImportError:
+        pytest.skip("No tensorflow available")
+
+    tf.enable_v2_behavior()
+    assert tf.executing_eagerly(), "Eager execution should be enabled."
+
+    # #37b24d
+    with capture_and_validate():
+        a = tf.constant([0x37, 0xb2, 0x4d], dtype=tf.uint8)
+        a = tf.broadcast_to(a, [32, 32, 3])
+        imgcat(a)
+
+    # float32 tensors
+    with capture_and_validate():
+        a = tf.fill([32, 32, 3], 0.5)
+        a = tf.cast(a, dtype=tf.float32)
+        imgcat(a)
+
+
+@parametrize_env
+def test_matplotlib(capture_and_validate, mpl_figure):
+    # plt
+    with capture_and_validate():
+        imgcat(mpl_figure)
+
+    # without canvas
+    with capture_and_validate():
+        fig = matplotlib.figure.Figure(figsize=(2, 2))
+        imgcat(fig)
+
+
+@parametrize_env
+def test_pil():
+    a = np.full([32, 32], 255, dtype=np.uint8)
+    im = Image.fromarray(a)
+    imgcat(im)
+
+
+def test_pil_passthrough():
+    '''An image file opened with PIL is displayed without re-encoding.'''
+
+    a = np.random.RandomState(0).randint(0, 256, [32, 32, 3], dtype=np.uint8)
+    b = io.BytesIO()
+    Image.fromarray(a).save(b, format='JPEG')
+    jpg = b.getvalue()
+
+    im = Image.open(io.BytesIO(jpg))
+    assert bytes(to_content_buf(im)) == jpg
+
+    # once modified, the image should be encoded again
+    im.putpixel((0, 0), (255, 0, 0))
+    assert bytes(to_content_buf(im))[:4] == b'\x89PNG'
+
+    # or if the image differs from the file before loading (draft mode)
+    for mode, size in [('L', (16, 16)), ('L', (32, 32)), ('RGB', (16, 16))]:
+        im = Image.open(io.BytesIO(jpg))
+        im.draft(mode, size)
+        buf = to_content_buf(im)
+        assert bytes(buf)[:4] == b'\x89PNG'
+        decoded = Image.open(io.BytesIO(buf))
+        assert (decoded.mode, decoded.size) == (im.mode, im.size)
+
+
+@parametrize_env
+def test_bytes(capture_and_validate):
+    '''Test imgcat from byte-represented image.
+    TODO: validate height, filesize from the imgcat output sequences.'''
+
+    # PNG
+    with capture_and_validate():
+        imgcat(_PNG_BYTES)
+
+    # JPG
+    with capture_and_validate():
+        imgcat(_JPG_BYTES)
+
+    # GIF
+    with capture_and_validate():
+        imgcat(_GIF_BYTES)
+
+    # other bytes-like objects
+    with capture_and_validate():
+        imgcat(bytearray(_PNG_BYTES))
+    with capture_and_validate():
+        imgcat(memoryview(_PNG_BYTES))
+    with capture_and_validate():
+        imgcat(io.BytesIO(_PNG_BYTES))
+
+
+@pytest.mark.parametrize('data, digest', [
+    (_PNG_BYTES, '2cf175f8b72e822e'),
+    (_JPG_BYTES, '6fa22e29e99a2f4b'),
+    (_GIF_BYTES, '4b4a05242ca24920'),
+], ids=['png', 'jpg', 'gif'])
+def test_bytes_digest(monkeypatch, data, digest):
+    '''The output for encoded images is deterministic.'''
+    monkeypatch.delenv("TMUX", raising=False)
+    b = io.BytesIO()
+    imgcat(data, fp=b)
+    _validate_iterm2(b.getvalue(), digest=digest)
+
+
+def test_memoryview_size():
+    '''The size of a memoryview content is the number of bytes, not items.'''
+    import array
+
+    content = memoryview(array.array('I', [1, 2, 3, 4]))
+    b = io.BytesIO()
+    imgcat(content, height=1, fp=b)
+    assert b';size=%d;' % content.nbytes in b.getvalue()
+
+    with pytest.raises(TypeError):
+        imgcat(memoryview(bytes(16))[::2], height=1, fp=io.BytesIO())
+
+
+@pytest.mark.parametrize('fmt, save_kwargs', [
+    ('PNG', {}), ('GIF', {}), ('BMP', {}),
+    ('JPEG', {}), ('JPEG', {'progressive': True}),
+    ('JPEG', {'exif': b'Exif\x00\x00II*\x00\x08\x00\x00\x00\x00\x00',
+              'icc_profile': b'\x00' * 70000}),   # APPn segments before SOFn
+    ('WEBP', {}), ('WEBP', {'lossless': True}),
+])
+def test_get_image_shape(fmt, save_kwargs):
+    if fmt == 'WEBP' and not features.check('webp'):
+        pytest.skip("Pillow is built without WEBP support")
+
+    b = io.BytesIO()
+    Image.new('RGB', (37, 21)).save(b, format=fmt, **save_kwargs)
+    assert get_image_shape(b.getvalue()) == (37, 21)
+
+
+def test_get_image_shape_large():
+    # GIF dimensions are unsigned 16-bit integers
+    gif_header = b'GIF89a' + (40000).to_bytes(2, 'little') + (2).to_bytes(2, 'little')
+    assert get_image_shape(gif_header) == (40000, 2)
+
+
+@pytest.fixture
+def pil_open_calls(monkeypatch):
+    '''Counts the calls to PIL.Image.open(), starting with an empty shape cache.'''
+    monkeypatch.setattr(imgcat_module, '_SHAPE_CACHE', collections.OrderedDict())
+    calls = []
+    _open = Image.open
+
+    def _counting_open(*args, **kwargs):
+        calls.append(args)
+        return _open(*args, **kwargs)
+
+    monkeypatch.setattr(Image, 'open', _counting_open)
+    return calls
+
+
+def _tiff_bytes(width, height):
+    b = io.BytesIO()
+    Image.new('L', (width, height)).save(b, format='TIFF')
+    return b.getvalue()
+
+
+def test_get_image_shape_cache(monkeypatch, pil_open_calls):
+    '''Shapes that require PIL are cached for the most recently used buffers.'''
+    monkeypatch.setattr(imgcat_module, '_SHAPE_CACHE_MAXSIZE', 2)
+    t1, t2, t3 = _tiff_bytes(1, 5), _tiff_bytes(2, 5), _tiff_bytes(3, 5)
+
+    assert get_image_shape(t1) == (1, 5)
+    assert get_image_shape(t1) == (1, 5)
+    assert len(pil_open_calls) == 1          # hit
+
+    assert get_image_shape(t2) == (2, 5)
+    assert get_image_shape(t1) == (1, 5)     # t1 is now the most recent
+    assert get_image_shape(t3) == (3, 5)     # evicts t2
+    assert len(pil_open_calls) == 3
+
+    assert get_image_shape(t1) == (1, 5)
+    assert len(pil_open_calls) == 3
+    assert get_image_shape(t2) == (2, 5)
+    assert len(pil_open_calls) == 4
+
+    # failures are not cached
+    invalid = b'0' * 32
+    assert get_image_shape(invalid) == (None, None)
+    assert get_image_shape(invalid) == (None, None)
+    assert len(pil_open_calls) == 6
+
+
+def test_get_image_shape_cache_threads(monkeypatch, pil_open_calls):
+    '''Evictions from other threads do not break a lookup.'''
+
+    class _SlowOrderedDict(collections.OrderedDict):
+        def __contains__(self, key):
+            found = super().__contains__(key)
+            time.sleep(1e-4)   # let other threads run between check and use
+            return found
+
+    monkeypatch.setattr(imgcat_module, '_SHAPE_CACHE', _SlowOrderedDict())
+    monkeypatch.setattr(imgcat_module, '_SHAPE_CACHE_MAXSIZE', 2)
+    tiffs = [_tiff_bytes(w, 3) for w in range(1, 9)]
+    errors = []
+
+    def _worker():
         try:
-            import tensorflow.compat.v2 as tf  # type: ignore # noqa
-        except ImportError:
-            pytest.skip("No tensorflow available")
-
-        tf.enable_v2_behavior()
-        assert tf.executing_eagerly(), "Eager execution should be enabled."
-
-        # #37b24d
-        with self.capture_and_validate():
-            a = tf.constant([0x37, 0xb2, 0x4d], dtype=tf.uint8)
-            a = tf.tile(a[None, None, :], [32, 32, 1])  # [32, 32, 3]
-            imgcat(a)
-
-        # float32 tensors
-        with self.capture_and_validate():
-            a = tf.fill([32, 32, 3], 0.5)
-            a = tf.cast(a, dtype=tf.float32)
-            imgcat(a)
-
-    @parametrize_env
-    def test_matplotlib(self):
-        # plt
-        with self.capture_and_validate():
-            import matplotlib.pyplot as plt
-            fig, ax = plt.subplots(figsize=(2, 2))
-            ax.plot([0, 1])
-            fig.tight_layout()
-            imgcat(fig)
-
-        # without canvas
-        with self.capture_and_validate():
-            import matplotlib.figure
-            fig = matplotlib.figure.Figure(figsize=(2, 2))
-            imgcat(fig)
-
-    @parametrize_env
-    def test_pil(self):
-        from PIL import Image
-        a = np.ones([32, 32], dtype=np.uint8) * 255
-        im = Image.fromarray(a)
-        imgcat(im)
-
-    @parametrize_env
-    def test_bytes(self):
-        '''Test imgcat from byte-represented image.
-        TODO: validate height, filesize from the imgcat output sequences.'''
-        import base64
-
-        # PNG
-        # https://github.com/mathiasbynens/small/blob/master/png-transparent.png
-        with self.capture_and_validate():
-            png = base64.b64decode(b'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAACklEQVR4nGMAAQAABQABDQottAAAAABJRU5ErkJggg==')
-            imgcat(png)
-
-        # JPG
-        # https://github.com/mathiasbynens/small/blob/master/jpeg.jpg
-        with self.capture_and_validate():
-            jpg = base64.b64decode(b'/9j/2wBDAAMCAgICAgMCAgIDAwMDBAYEBAQEBAgGBgUGCQgKCgkICQkKDA8MCgsOCwkJDRENDg8QEBEQCgwSExIQEw8QEBD/yQALCAABAAEBAREA/8wABgAQEAX/2gAIAQEAAD8A0s8g/9k=')
-            imgcat(jpg)
-
-        # GIF
-        # http://probablyprogramming.com/2009/03/15/the-tiniest-gif-ever
-        with self.capture_and_validate():
-            gif = base64.b64decode(b'R0lGODlhAQABAIABAP///wAAACH5BAEKAAEALAAAAAABAAEAAAICTAEAOw==')
-            imgcat(gif)
-
-    @parametrize_env
-    def test_invalid_data(self):
-        # invalid bytes. TODO: capture stderr
-        with self.capture_and_validate():
-            invalid = b'0' * 32
-            imgcat(invalid)
-
-    # ----------------------------------------------------------------------
-    # Arguments, etc.
-
-    @parametrize_env
-    def test_args_filename(self):
-        gray = np.ones([32, 32], dtype=np.uint8) * 128
-        imgcat(gray, filename='foo.png')
-        imgcat(gray, filename='unicode_한글.png')
-
-    @parametrize_env
-    def test_args_another(self):
-        b = io.BytesIO()
-
-        gray = np.ones([32, 32], dtype=np.uint8) * 128
-        imgcat(gray, filename='foo.png', width=10, height=12,
-               preserve_aspect_ratio=False, fp=b)
-
-        v = b.getvalue()
-        assert b'size=82;' in v
-        assert b'height=12;' in v
-        assert b'width=10;' in v
-        assert b'name=Zm9vLnBuZw==;' in v   # foo.png
-        assert b'preserveAspectRatio=0' in v
+            for _ in range(20):
+                for w, t in enumerate(tiffs, 1):
+                    assert get_image_shape(t) == (w, 3)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=_worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    assert len(imgcat_module._SHAPE_CACHE) <= 2
+
+
+def test_get_tty_size_cache(monkeypatch):
+    '''The tty size is queried again only after _TTY_SIZE_TTL seconds.'''
+    now = [100.0]
+    calls = []
+
+    def _get_terminal_size(fd):
+        calls.append(fd)
+        return os.terminal_size((80 + len(calls), 24))
+
+    monkeypatch.setattr(imgcat_module, '_TTY_SIZE_CACHE', None)
+    monkeypatch.setattr(imgcat_module.time, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(imgcat_module.os, 'get_terminal_size', _get_terminal_size)
+    monkeypatch.setattr(sys, 'stdout', types.SimpleNamespace(fileno=lambda: 1))
+
+    assert get_tty_size() == (24, 81)
+    now[0] += imgcat_module._TTY_SIZE_TTL / 2
+    assert get_tty_size() == (24, 81)
+    assert len(calls) == 1
+
+    now[0] += imgcat_module._TTY_SIZE_TTL
+    assert get_tty_size() == (24, 82)
+    assert len(calls) == 2
+
+
+def test_lazy_converters(monkeypatch):
+    '''A type is picked up as soon as its module is imported.'''
+
+    class Fake:
+        pass
+
+    fake_module = types.ModuleType('_imgcat_fake_module')
+    fake_module.Fake = Fake
+    monkeypatch.delitem(sys.modules, fake_module.__name__, raising=False)
+    monkeypatch.setattr(imgcat_module, '_LAZY_CONVERTERS', (
+        (fake_module.__name__, 'Fake', lambda data: _PNG_BYTES),
+    ) + imgcat_module._LAZY_CONVERTERS)
+    monkeypatch.setattr(imgcat_module, '_LAZY_CONVERTERS_CACHE', (-1, ()))
+
+    # not resolved, nor looked up again, until a module is imported
+    with pytest.raises(TypeError):
+        to_content_buf(Fake())
+    converters = imgcat_module._lazy_converters()
+    assert imgcat_module._lazy_converters() is converters
+    assert Fake not in [clstype for clstype, _ in converters]
+
+    monkeypatch.setitem(sys.modules, fake_module.__name__, fake_module)
+    assert to_content_buf(Fake()) == _PNG_BYTES
+
+
+@parametrize_env
+def test_invalid_data(capture_and_validate):
+    # invalid bytes. TODO: capture stderr
+    with capture_and_validate():
+        invalid = b'0' * 32
+        imgcat(invalid)
+
+
+# ----------------------------------------------------------------------
+# Arguments, etc.
+
+@parametrize_env
+def test_args_filename():
+    gray = np.full([32, 32], 128, dtype=np.uint8)
+    imgcat(gray, filename='foo.png')
+    imgcat(gray, filename='unicode_한글.png')
+
+
+@parametrize_env
+def test_args_another():
+    b = io.BytesIO()
+
+    gray = np.full([32, 32], 128, dtype=np.uint8)
+    imgcat(gray, filename='foo.png', width=10, height=12,
+           preserve_aspect_ratio=False, fp=b)
+
+    v = b.getvalue()
+    assert b'size=88;' in v
+    assert b'height=12;' in v
+    assert b'width=10;' in v
+    assert b'name=Zm9vLnBuZw==;' in v   # foo.png
+    assert b'preserveAspectRatio=0' in v
+
+
+def test_write_error():
+    '''A failed write does not keep the content buffer exported.'''
+
+    class _BrokenPipe(io.RawIOBase):
+        def write(self, b):
+            raise BrokenPipeError(32, 'Broken pipe')
+
+    content = bytearray(bytes(range(256)) * 1000)
+    with pytest.raises(BrokenPipeError) as excinfo:
+        imgcat(content, height=10, fp=_BrokenPipe())
+    # the traceback (and its frames) are still alive here, as in sys.excepthook
+    assert excinfo.traceback
+    content.clear()   # raises BufferError if a memoryview is still held
+
+
+def test_large_payload():
+    '''The payload is encoded in chunks; it should be identical to
+    the base64 encoding of the whole content.'''
+
+    content = bytes(range(256)) * 1000   # ~256KB, spans multiple chunks
+    b = io.BytesIO()
+    imgcat(content, height=10, fp=b)
+
+    v = b.getvalue()
+    payload = v[v.index(b':') + 1 : v.rindex(b'\a')]
+    assert payload == base64.b64encode(content)
 
 
 if __name__ == '__main__':
@@ -27,14 +27,18 @@ install_requires = [
 ]
 
 tests_requires = [
-    'pytest',
+    'pytest>=6.2',  # pytest.MonkeyPatch
     'numpy',
-    'torch',
-    'tensorflow>=2.0',
     'matplotlib>=3.3',
     'Pillow',
 ]
 
+# torch and tensorflow tests are skipped if not installed
+tests_full_requires = tests_requires + [
+    'torch',
+    'tensorflow>=2.0',
+]
+
 __version__ = read_version()
 
 
@@ -65,7 +69,10 @@ setup(
     packages=['imgcat'],
     python_requires='>=3.6',
     install_requires=install_requires,
-    extras_require={'test': tests_requires},
+    extras_require={
+        'test': tests_requires,
+        'test-full': tests_full_requires,
+    },
     entry_points={
         'console_scripts': ['imgcat=imgcat:main'],
     },